@@ -1,30 +1,81 @@
 #!/usr/bin/env python3
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from argparse import (
+    ArgumentParser, ArgumentDefaultsHelpFormatter, ArgumentTypeError)
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import re
+import subprocess
 import sys
-import glob
 import shutil
+import threading
 from hashlib import sha1
 from itertools import chain
 
+# With --rsync, hand the organized copies to rsync when there are at least
+# this many
+RSYNC_MIN_FILES = 32
+# Copy threads log too, and print() writes each part of a line separately
+LOG_LOCK = threading.Lock()
+
 
 class Filter:
     def __init__(self, s: str, d: str, root: str):
         self.is_negative = s.startswith('!')
         if self.is_negative:
             s = s[1:]
-        self.re = re.compile(os.path.join(re.escape(root), s))
+        self.pattern = os.path.join(re.escape(root), s)
+        self.re = re.compile(self.pattern)
+        # The top-level library dir every match must be under, if the regex
+        # starts with one spelled out literally
+        self.top_dname = None
+        prefix = _literal_prefix(s)
+        if '/' in prefix and not prefix.startswith('/'):
+            self.top_dname = prefix.split('/')[0]
         self.is_organized = d != 'shuffled'
         self.is_shuffled = d != 'organized'
 
-    def _items(self):
-        yield from glob.iglob(self.glob, recursive=True)
 
-    def should_include(self, fname: str):
-        if self.re.match(fname):
-            return not self.is_negative
-        return None
+class FilterSet:
+    # All the filters compiled into one alternation. The regex engine tries
+    # the alternatives left to right, so the first filter to match a file
+    # still decides its fate, but it takes one match() call instead of one
+    # per filter.
+    def __init__(self, filters):
+        self.filters = filters
+        self.by_group = {f'_f{i}': filt for i, filt in enumerate(filters)}
+        self.re = None
+        # Wrapping filters in groups renumbers their own groups and can
+        # clash with their group names, so those get matched one at a time
+        if filters and not any(filt.re.groups for filt in filters):
+            try:
+                self.re = re.compile('|'.join(
+                    f'(?P<{g}>{filt.pattern})'
+                    for g, filt in self.by_group.items()))
+            except re.error:
+                pass
+
+    def match(self, fname: str):
+        if self.re is None:
+            for filt in self.filters:
+                if filt.re.match(fname):
+                    return filt
+            return None
+        m = self.re.match(fname)
+        if m is None:
+            return None
+        return self.by_group[m.lastgroup]
+
+    def top_dnames(self):
+        # The only top-level library dirs that could contain an included
+        # file, or None if some filter could match anywhere
+        dnames = set()
+        for filt in self.filters:
+            if filt.is_negative:
+                continue
+            if filt.top_dname is None:
+                return None
+            dnames.add(filt.top_dname)
+        return dnames
 
 
 def fatal(*a, **kw):
@@ -45,46 +96,131 @@ def debug(*a, **kw):
 
 
 def _log(*a, **kw):
-    print(*a, file=sys.stderr, **kw)
+    with LOG_LOCK:
+        print(*a, file=sys.stderr, **kw)
 
 
-def gen_input_files(filters, library):
-    all_files = glob.iglob(
-        os.path.join(library, '**'),
-        recursive=True)
-    info(f'Scanning over all files in {library}')
-    for fname in all_files:
-        if os.path.isdir(fname):
-            continue
-        for filt in filters:
-            ret = filt.should_include(fname)
-            if ret:
-                yield fname, (filt.is_organized, filt.is_shuffled)
-                break
-            elif ret is False:
+def _literal_prefix(s: str):
+    # The literal text that every match of regex s has to start with. This
+    # only needs to be conservative: stopping early just means less pruning.
+    if '|' in s:
+        return ''
+    prefix = ''
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c in '*?{':
+            # The previous character was optional
+            return prefix[:-1]
+        if c in '+.^$[]()':
+            break
+        if c == '\\':
+            if i + 1 == len(s) or s[i + 1].isalnum():
                 break
-            # no info on whether or not to include, look at next filter
-            assert ret is None
+            i += 1
+            c = s[i]
+        prefix += c
+        i += 1
+    return prefix
+
+
+def _walk(root, files_only=False):
+    # Yield every non-directory under root, or only the regular files if
+    # files_only. Like glob's '**', hidden entries are skipped and unreadable
+    # directories are silently ignored, but DirEntry's cached d_type saves a
+    # stat() per entry.
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif not files_only or entry.is_file():
+                    yield entry.path
+
+
+def gen_input_files(filters, all_files):
+    for fname in all_files:
+        filt = filters.match(fname)
+        if filt is not None and not filt.is_negative:
+            yield fname, (filt.is_organized, filt.is_shuffled)
 
 
-def hash_string(s: str):
-    return sha1(s.encode('utf-8')).hexdigest()
+def hash_string(s: str, n_bytes: int = 4):
+    # This names the files in the shuffled dir, so changing the hash function
+    # would make the next run recopy every one of them under a new name
+    return sha1(s.encode('utf-8')).digest()[:n_bytes].hex()
 
 
-def copy_file(input_fname, out_fname):
-    os.makedirs(os.path.dirname(out_fname), exist_ok=True)
-    if os.path.exists(out_fname):
+def copy_file(input_fname, out_fname, existing, made_dnames, lock, link=False):
+    if out_fname in existing:
         info(f'Skipping {out_fname}')
-    else:
-        info(f'Copying  {out_fname}')
-        shutil.copy2(input_fname, out_fname)
+        return
+    # Only the first copy into a directory needs to create it
+    dname = os.path.dirname(out_fname)
+    with lock:
+        if dname not in made_dnames:
+            os.makedirs(dname, exist_ok=True)
+            made_dnames.add(dname)
+    if link:
+        # Only works if the drive's filesystem has hard links (FAT doesn't)
+        try:
+            os.link(input_fname, out_fname)
+        except OSError:
+            pass
+        else:
+            info(f'Linking  {out_fname}')
+            existing.add(out_fname)
+            return
+    info(f'Copying  {out_fname}')
+    shutil.copy2(input_fname, out_fname)
+    existing.add(out_fname)
+
+
+def delete_file(fname):
+    debug(f'Deleting {fname}')
+    os.unlink(fname)
+
+
+def rsync_files(rsync, src_dname, dst_dname, partial_fnames):
+    # --files-from implies --relative, so each file lands at the same path
+    # under dst_dname as it has under src_dname, like the organized dir wants.
+    # --copy-links copies what symlinked tracks point to, like copy2 does.
+    info(f'Copying  {len(partial_fnames)} files to {dst_dname} with rsync')
+    ret = subprocess.run(
+        [
+            rsync, '--copy-links', '--perms', '--times', '--ignore-existing',
+            '--from0', '--files-from=-', src_dname, dst_dname],
+        input=b''.join(os.fsencode(f) + b'\0' for f in partial_fnames))
+    if ret.returncode != 0:
+        error(f'rsync exited with status {ret.returncode}')
+
+
+def positive_int(s):
+    i = int(s)
+    if i < 1:
+        raise ArgumentTypeError(f'{s} is not a positive integer')
+    return i
 
 
 def main(
         library_dname, include_fname,
-        organized_dname, shuffled_dname, delete_excluded_files):
+        organized_dname, shuffled_dname, delete_excluded_files,
+        copy_jobs, use_rsync):
     os.makedirs(organized_dname, exist_ok=True)
     os.makedirs(shuffled_dname, exist_ok=True)
+    # List the drive once up front instead of stat()ing every destination
+    # Only regular files count: anything else at an output path (like a
+    # broken symlink) can't be copied from and isn't ours to delete
+    existing = set(chain(
+        _walk(organized_dname, files_only=True),
+        _walk(shuffled_dname, files_only=True)))
     filters = []
     with open(include_fname, 'rt') as fd:
         for line in fd:
@@ -98,41 +234,100 @@ def main(
             assert d in {'both', 'organized', 'shuffled'}
             debug(f'Loading filter {f}')
             filters.append(Filter(f, d, library_dname))
-    input_files_gen = gen_input_files(filters, library_dname)
+    filter_set = FilterSet(filters)
+    # Don't bother walking artists that no filter could include
+    top_dnames = filter_set.top_dnames()
+    if top_dnames is None:
+        roots = [library_dname]
+    else:
+        roots = [
+            os.path.join(library_dname, d) for d in sorted(top_dnames)
+            if not d.startswith('.')]
+    info(f'Scanning over all files in {library_dname}')
+    all_files = [fname for root in roots for fname in _walk(root)]
+    input_files_gen = gen_input_files(filter_set, all_files)
     included_files = set()
-    for input_fname, (is_organized, is_shuffled) in input_files_gen:
-        partial_fname = input_fname[
-                len(os.path.commonpath([library_dname, input_fname])):]
-        if partial_fname.startswith('/'):
-            partial_fname = partial_fname[1:]
-        # Copy to organized dir
-        if is_organized:
-            out_fname = os.path.join(organized_dname, partial_fname)
-            copy_file(input_fname, out_fname)
-            included_files.add(out_fname)
-        # Copy to shuffled dir
-        if is_shuffled:
-            split = os.path.splitext(os.path.basename(input_fname))
-            out_fname = os.path.join(
-                shuffled_dname,
-                f'{split[0]} - {hash_string(input_fname)[:8]}{split[1]}')
-            copy_file(input_fname, out_fname)
-            included_files.add(out_fname)
+    made_dnames = {organized_dname, shuffled_dname}
+    made_dnames.update(os.path.dirname(fname) for fname in existing)
+    lock = threading.Lock()
+    organized = []
+    # Shuffled copies of files that also go in the organized dir. These are
+    # made from the organized copy so the library only gets read once.
+    from_organized = []
+    # Every input file path is library_dname joined with something, so the
+    # part after it can be sliced off without looking at the path
+    strip_n = len(os.path.join(library_dname, ''))
+    # Likewise build output paths by concatenation, not os.path.join()
+    org_prefix = os.path.join(organized_dname, '')
+    shuf_prefix = os.path.join(shuffled_dname, '')
+    with ThreadPoolExecutor(max_workers=copy_jobs) as pool:
+        futures = []
+        for input_fname, (is_organized, is_shuffled) in input_files_gen:
+            partial_fname = input_fname[strip_n:]
+            # Copy to organized dir
+            if is_organized:
+                org_fname = f'{org_prefix}{partial_fname}'
+                organized.append((input_fname, partial_fname, org_fname))
+                included_files.add(org_fname)
+            # Copy to shuffled dir
+            if is_shuffled:
+                # Same as splitext(basename()) given the walker skips dotfiles
+                base = input_fname[input_fname.rfind(os.sep) + 1:]
+                dot = base.rfind('.')
+                if dot > 0:
+                    name, ext = base[:dot], base[dot:]
+                else:
+                    name, ext = base, ''
+                h = hash_string(input_fname)
+                out_fname = f'{shuf_prefix}{name} - {h}{ext}'
+                if is_organized:
+                    from_organized.append((org_fname, out_fname))
+                else:
+                    futures.append(pool.submit(
+                        copy_file, input_fname, out_fname,
+                        existing, made_dnames, lock))
+                included_files.add(out_fname)
+        # Shuffled copies are already running in the pool. rsync can't rename
+        # files, but it is much faster than copy2 at the organized ones.
+        pending = []
+        for input_fname, partial_fname, out_fname in organized:
+            if out_fname in existing:
+                info(f'Skipping {out_fname}')
+            else:
+                pending.append((input_fname, partial_fname, out_fname))
+        rsync = shutil.which('rsync') if use_rsync else None
+        if rsync is not None and len(pending) >= RSYNC_MIN_FILES:
+            rsync_files(
+                rsync, library_dname, organized_dname,
+                [partial_fname for _, partial_fname, _ in pending])
+            # rsync can skip a file and keep going, so only trust what actually
+            # made it onto the drive and copy the rest ourselves
+            left = []
+            for item in pending:
+                if os.path.isfile(item[2]):
+                    existing.add(item[2])
+                else:
+                    left.append(item)
+            pending = left
+        for input_fname, _, out_fname in pending:
+            futures.append(pool.submit(
+                copy_file, input_fname, out_fname,
+                existing, made_dnames, lock))
+        for fut in as_completed(futures):
+            fut.result()
+        futures = [
+            pool.submit(
+                copy_file, org_fname, out_fname,
+                existing, made_dnames, lock, link=True)
+            for org_fname, out_fname in from_organized]
+        for fut in as_completed(futures):
+            fut.result()
     # Delete music files that didn't match any input library files
     if delete_excluded_files:
-        for fname in chain(
-                glob.iglob(
-                    os.path.join(organized_dname, '**'), recursive=True),
-                glob.iglob(
-                    os.path.join(shuffled_dname, '**'), recursive=True)):
-            # Don't try to delete directories
-            if not os.path.isfile(fname):
-                continue
-            # Don't delete files that were included
-            if fname in included_files:
-                continue
-            debug(f'Deleting {fname}')
-            os.unlink(fname)
+        with ThreadPoolExecutor(max_workers=copy_jobs) as pool:
+            # Consume the results so a failed unlink is raised
+            for _ in pool.map(delete_file, existing - included_files):
+                pass
     os.sync()
     return 0
 
@@ -159,6 +354,14 @@ if __name__ == '__main__':
         '--delete-excluded-files', help='If a music file on the drive '
         'doesn\'t match any included file in the library, delete it.',
         default=False, action='store_true')
+    p.add_argument(
+        '--copy-jobs', help='How many files to copy or delete at the same '
+        'time.',
+        default=16, type=positive_int)
+    p.add_argument(
+        '--rsync', help='If rsync is installed, use it to copy files into '
+        'the organized directory when there are many of them.',
+        default=False, action='store_true')
     args = p.parse_args()
     exit(main(
         args.library,
@@ -166,4 +369,6 @@ if __name__ == '__main__':
         os.path.join(args.drive_folder, args.organized_dir),
         os.path.join(args.drive_folder, args.shuffled_dir),
         args.delete_excluded_files,
+        args.copy_jobs,
+        args.rsync,
     ))